@@ -2,7 +2,9 @@
 # dedalus_magic.py 
 # ==================================================
 
-import os, subprocess, tempfile, textwrap, shlex
+import os, sys, errno, codecs, pty, termios, select, signal, shutil, subprocess, tempfile, textwrap, shlex, uuid, atexit
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
 from IPython.core.magic import register_cell_magic
 
 # --------------------------------------------------
@@ -12,83 +14,332 @@ MICROMAMBA = "/content/micromamba/bin/micromamba"
 ENV_NAME = "dedalus"
 
 # --------------------------------------------------
-# MPI detection helpers
+# Activate the env once, so cells exec its binaries directly
+# instead of going through `micromamba run` every time
 # --------------------------------------------------
-def detect_mpi(env):
+def _activate_env():
+    """Return the variables `micromamba run` would set or change, or None."""
     try:
         out = subprocess.run(
-            ["mpiexec", "--version"],
-            env=env, capture_output=True, text=True, timeout=2
+            [MICROMAMBA, "run", "-n", ENV_NAME, "env", "-0"],
+            capture_output=True, check=True, timeout=60
         )
-        txt = (out.stdout + out.stderr).lower()
-        if "open mpi" in txt or "open-mpi" in txt:
-            return "openmpi"
     except Exception:
-        pass
-    return "mpich"
+        return None
+    activated = {}
+    for item in out.stdout.decode(errors="replace").split("\0"):
+        key, sep, value = item.partition("=")
+        if sep and os.environ.get(key) != value:
+            activated[key] = value
+    return activated if "CONDA_PREFIX" in activated else None
+
+_ACTIVATED_ENV = _activate_env()
+
+# Activation prepends to PATH-like variables; keep just the prepended part
+# so each cell builds them from the notebook's *current* value
+_ENV_PREPEND = {}
+for _key in [k for k in (_ACTIVATED_ENV or {}) if k.endswith("PATH")]:
+    _value, _old = _ACTIVATED_ENV.pop(_key), os.environ.get(_key)
+    if _old and _value.endswith(os.pathsep + _old):
+        _value = _value[:-len(os.pathsep + _old)]
+    _ENV_PREPEND[_key] = _value
+
+if _ACTIVATED_ENV is not None:
+    ENV_PREFIX = _ACTIVATED_ENV["CONDA_PREFIX"]
+    _ENV_PATH  = os.pathsep.join(
+        [_ENV_PREPEND.get("PATH", f"{ENV_PREFIX}/bin"), os.environ.get("PATH", "")]
+    )
+    PYTHON  = shutil.which("python", path=_ENV_PATH) or f"{ENV_PREFIX}/bin/python"
+    MPIEXEC = shutil.which("mpiexec", path=_ENV_PATH) or "mpiexec"
+    MPIRUN  = shutil.which("mpirun", path=_ENV_PATH) or MPIEXEC
+else:
+    # Fall back to `micromamba run` (see build_cmd)
+    ENV_PREFIX, PYTHON, MPIEXEC, MPIRUN = None, "python", "mpiexec", "mpirun"
+
+# Variables every cell runs with: thread counts default to 1 (one thread
+# per MPI rank, as dedalus recommends) unless the notebook sets them, and
+# the OpenMPI root flags and env activation always apply.
+_ENV_DEFAULTS = {
+    "OMP_NUM_THREADS": "1",
+    "NUMEXPR_MAX_THREADS": "1",
+}
+_ENV_OVERLAY = {
+    "OMPI_ALLOW_RUN_AS_ROOT": "1",
+    "OMPI_ALLOW_RUN_AS_ROOT_CONFIRM": "1",
+    **(_ACTIVATED_ENV or {}),
+}
+
+def _cell_env():
+    """Environment for one cell: the notebook's os.environ, activated."""
+    env = {**_ENV_DEFAULTS, **os.environ, **_ENV_OVERLAY}
+    for key, prefix in _ENV_PREPEND.items():
+        old = os.environ.get(key)
+        env[key] = f"{prefix}{os.pathsep}{old}" if old else prefix
+    return env
+
+# Let subprocess use posix_spawn (vfork) instead of fork, which would copy
+# the page tables of a kernel that may hold GBs of arrays. CPython only
+# takes that path with close_fds=False, no cwd/preexec_fn and an absolute
+# executable; fds Python opens are non-inheritable anyway (PEP 446).
+_SPAWN_KW = {"close_fds": False}
+
+# --------------------------------------------------
+# MPI detection helpers
+# --------------------------------------------------
+# The MPI implementation doesn't change between cells, so probe it once per
+# (micromamba, env) pair and reuse the result. `--refresh-mpi` clears it.
+_MPI_CACHE = {}
+_OPENMPI_TAGS = ("open mpi", "open-mpi", "openrte")
+
+def detect_mpi(env):
+    """Return (implementation, version line) from one `mpiexec --version`."""
+    key = (MICROMAMBA, ENV_NAME)
+    if key not in _MPI_CACHE:
+        impl, ver = "mpich", "unknown"
+        try:
+            out = subprocess.run(
+                [MPIEXEC, "--version"],
+                env=env, capture_output=True, text=True, timeout=2,
+                **_SPAWN_KW
+            )
+            # only the first line names the implementation
+            # ("mpiexec (Open MPI) 5.x", "mpiexec (OpenRTE) 4.x", ...)
+            first = (out.stdout or out.stderr).split("\n", 1)[0]
+            low = first.lower()
+            if any(tag in low for tag in _OPENMPI_TAGS):
+                impl = "openmpi"
+            if first:
+                ver = first
+        except Exception:
+            pass
+        _MPI_CACHE[key] = (impl, ver)
+    return _MPI_CACHE[key]
 
-def mpi_version(env):
+
+# --------------------------------------------------
+# Cell script files
+# --------------------------------------------------
+# Scripts go to a private directory on tmpfs (RAM) when /dev/shm is
+# writable. It must be a real directory: the child's sys.path[0] is the
+# script's directory, and a memfd under /proc would resolve that to "/".
+_SCRIPT_DIR = Path(tempfile.mkdtemp(
+    prefix="dedalus_cells_",
+    dir="/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+))
+atexit.register(shutil.rmtree, _SCRIPT_DIR, ignore_errors=True)
+
+@contextmanager
+def _script_file(code):
+    """Yield the path of a file holding *code*; it is removed afterwards."""
+    script = _SCRIPT_DIR / f"dedalus_{uuid.uuid4().hex}.py"
+    script.write_text(code)
     try:
-        out = subprocess.run(
-            ["mpiexec", "--version"],
-            env=env, capture_output=True, text=True, timeout=2
+        yield str(script)
+    finally:
+        os.remove(script)
+
+
+# --------------------------------------------------
+# Output streaming
+# --------------------------------------------------
+def _spawn(cmd, env):
+    """Start *cmd* on a pty; return (process, master fd to read from)."""
+    # A pty keeps the child's stdout line-buffered (on a pipe, libc and
+    # Python switch to block buffering and progress shows up in bursts)
+    master_fd, slave_fd = pty.openpty()
+    attrs = termios.tcgetattr(slave_fd)
+    attrs[1] &= ~termios.ONLCR          # keep "\n" instead of "\r\n"
+    termios.tcsetattr(slave_fd, termios.TCSANOW, attrs)
+    try:
+        process = subprocess.Popen(
+            cmd, env=env, stdin=subprocess.DEVNULL,
+            stdout=slave_fd, stderr=slave_fd,
+            **_SPAWN_KW
         )
-        return (out.stdout + out.stderr).splitlines()[0]
-    except Exception:
-        return "unknown"
+    except BaseException:
+        os.close(master_fd)
+        raise
+    finally:
+        os.close(slave_fd)
+    return process, master_fd
+
+def _pump(master_fd, until=None, count=1):
+    """Copy output from *master_fd* to the notebook.
+
+    Returns True once the bytes *until* have been seen *count* times (they
+    are not printed), or False once every writer of the pty has exited.
+    """
+    # ipykernel's stdout has no `.buffer`, so decode incrementally
+    # (a chunk may end in the middle of a multi-byte character)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    keep = len(until) - 1 if until else 0
+    tail = b""
+    while True:
+        # Wake up regularly so Ctrl-C is handled even while the child is quiet
+        ready, _, _ = select.select([master_fd], [], [], 0.2)
+        if not ready:
+            continue
+        try:
+            chunk = os.read(master_fd, 65536)
+        except OSError as e:
+            if e.errno != errno.EIO:       # EIO: every writer has exited
+                raise
+            chunk = b""
+        if not chunk:
+            sys.stdout.write(decoder.decode(tail, final=True))
+            sys.stdout.flush()
+            return False
+
+        data = tail + chunk
+        tail = b""
+        if until:
+            # feed the text around each marker through the same decoder,
+            # so a character split across a marker still decodes
+            *done, data = data.split(until)
+            for part in done:
+                sys.stdout.write(decoder.decode(part))
+            count -= len(done)
+            if count <= 0:
+                # anything after the last marker is still output of this cell
+                sys.stdout.write(decoder.decode(data, final=True))
+                sys.stdout.flush()
+                return True
+            # hold back only a suffix that could be the start of the marker
+            cut = len(data)
+            for n in range(min(keep, len(data)), 0, -1):
+                if until.startswith(data[-n:]):
+                    cut -= n
+                    break
+            data, tail = data[:cut], data[cut:]
+        sys.stdout.write(decoder.decode(data))
+        sys.stdout.flush()
+
+def _interrupt(process):
+    """Forward Ctrl-C to *process*, killing it if it doesn't exit promptly."""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def _stream(process, master_fd):
+    """Copy output from *master_fd* to the notebook until the child exits."""
+    try:
+        _pump(master_fd)
+    except KeyboardInterrupt:
+        _interrupt(process)
+        raise
+    finally:
+        os.close(master_fd)
+        process.wait()
+    return process.returncode
+
+def _run_streamed(cmd, env):
+    """Run *cmd*, copying its output to the notebook as it arrives."""
+    return _stream(*_spawn(cmd, env))
 
 
 # --------------------------------------------------
-# %%dedalus cell magic
+# Persistent MPI session (--session)
 # --------------------------------------------------
-@register_cell_magic
-def dedalus(line, cell):
-    args = shlex.split(line)
+# Rank 0 reads script paths from a FIFO and broadcasts them; every rank
+# exec()s the script in a fresh namespace, so MPI start-up and imports are
+# paid once per session instead of once per cell.
+#
+# The launcher forwards each rank's stdout and stderr in order, but not in
+# step with the other ranks, so every rank ends both of its streams with a
+# marker and a cell is done once all 2 * np markers have arrived.
+_SESSION_DONE = b"__DEDALUS_CELL_DONE__\n"
 
-    # -----------------------------
-    # Options
-    # -----------------------------
-    np = 1
-    info_mode = "--info" in args
-    time_mode = "--time" in args
+_SESSION_RUNNER = """
+import sys, traceback
+from mpi4py import MPI
 
-    if "-np" in args:
-        np = int(args[args.index("-np") + 1])
+_comm = MPI.COMM_WORLD
+_fifo = open(sys.argv[1]) if _comm.rank == 0 else None
 
-    # -----------------------------
-    # Environment
-    # -----------------------------
-    env = os.environ.copy()
-    env.update({
-        "OMPI_ALLOW_RUN_AS_ROOT": "1",
-        "OMPI_ALLOW_RUN_AS_ROOT_CONFIRM": "1",
-    })
+while True:
+    _path = _comm.bcast(_fifo.readline().strip() if _fifo else None, root=0)
+    if not _path:
+        break
+    try:
+        with open(_path) as _f:
+            _code = compile(_f.read(), _path, "exec")
+        exec(_code, {"__name__": "__main__", "__file__": _path})
+    except SystemExit:
+        pass
+    except BaseException:
+        # other ranks may be stuck in a collective: take the session down
+        traceback.print_exc()
+        sys.stderr.flush()
+        _comm.Abort(1)
+    _comm.Barrier()
+    # one write per marker, so other ranks' output can't split it
+    for _stream in (sys.stdout, sys.stderr):
+        _stream.write(%r)
+        _stream.flush()
+""" % _SESSION_DONE.decode()
 
-    mpi_impl = detect_mpi(env)
-    mpi_ver  = mpi_version(env)
+_SESSIONS = {}
 
-    # -----------------------------
-    # Command builder
-    # -----------------------------
-    def build_cmd(script):
-        if np == 1:
-            return [
-                MICROMAMBA, "run", "-n", ENV_NAME,
-                "python", script
-            ]
-
-        launcher = "mpirun" if mpi_impl == "openmpi" else "mpiexec"
-        return [
-            MICROMAMBA, "run", "-n", ENV_NAME,
-            launcher, "-n", str(np),
-            "python", script
-        ]
+class _MPISession:
+    """A long-lived launcher running `_SESSION_RUNNER` on every rank."""
 
-    # -----------------------------
-    # --info mode
-    # -----------------------------
-    if info_mode:
-        info_code = """
+    def __init__(self, nranks, build_cmd, env):
+        self.markers = 2 * nranks        # stdout + stderr of every rank
+        self.tmpdir = tempfile.mkdtemp(prefix="dedalus_session_")
+        runner = os.path.join(self.tmpdir, "runner.py")
+        with open(runner, "w") as f:
+            f.write(_SESSION_RUNNER)
+        fifo = os.path.join(self.tmpdir, "cells")
+        os.mkfifo(fifo)
+        # O_RDWR: doesn't block waiting for the reader, and keeps the
+        # FIFO open so rank 0 only sees EOF when we close it
+        self.fifo_fd = os.open(fifo, os.O_RDWR)
+        self.process, self.master_fd = _spawn(build_cmd(runner, fifo), env)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, script):
+        """Run *script* on every rank; False if the session died doing so."""
+        os.write(self.fifo_fd, f"{script}\n".encode())
+        return _pump(self.master_fd, until=_SESSION_DONE, count=self.markers)
+
+    def close(self):
+        os.close(self.fifo_fd)           # EOF on the FIFO ends the loop
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        os.close(self.master_fd)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+def _get_session(key, nranks, build_cmd, env):
+    """Return the live session for *key*, (re)starting it if needed."""
+    session = _SESSIONS.get(key)
+    if session is not None and not session.alive():
+        _SESSIONS.pop(key).close()
+        session = None
+    if session is None:
+        # one session at a time, so ranks of an old -np/env don't linger
+        _close_sessions()
+        session = _SESSIONS[key] = _MPISession(nranks, build_cmd, env)
+    return session
+
+def _close_sessions():
+    while _SESSIONS:
+        _SESSIONS.popitem()[1].close()
+
+atexit.register(_close_sessions)
+
+
+# --------------------------------------------------
+# --info script (static, so written once and reused)
+# --------------------------------------------------
+_INFO_CODE = """
 from mpi4py import MPI
 import dedalus, sys, platform, os
 
@@ -100,36 +351,25 @@ if comm.rank == 0:
     print("💻 Platform        :", platform.platform())
     print("🧵 Running as root :", os.geteuid() == 0)
 """
-        with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
-            f.write(info_code)
-            script = f.name
 
-        try:
-            res = subprocess.run(
-                build_cmd(script),
-                env=env, capture_output=True, text=True
-            )
-            print(res.stdout, end="")
-            print(res.stderr, end="")
-        finally:
-            os.remove(script)
-
-        print("\n🔎 dedalus runtime info")
-        print("-----------------------")
-        print(f"Environment        : {ENV_NAME}")
-        print(f"micromamba         : {MICROMAMBA}")
-        print(f"MPI implementation : {mpi_impl.upper()}")
-        print(f"MPI version        : {mpi_ver}")
-        print(f"MPI ranks (-np)    : {np}")
-        return
+def _install_info_script():
+    """Write `_INFO_CODE` under ~/.cache unless it's already there."""
+    path = Path.home() / ".cache" / "dedalus_magic" / "info.py"
+    try:
+        if not path.exists() or path.read_text() != _INFO_CODE:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(_INFO_CODE)
+    except OSError:
+        return None
+    return path
 
-    # -----------------------------
-    # Normal execution (with optional timing)
-    # -----------------------------
-    user_code = textwrap.dedent(cell)
+_INFO_SCRIPT = _install_info_script()
 
-    if time_mode:
-        wrapped = f"""
+
+# --------------------------------------------------
+# --time wrapper (user code goes in at column 0)
+# --------------------------------------------------
+_TIME_WRAPPER = """
 from mpi4py import MPI
 import time
 
@@ -160,19 +400,123 @@ _t1 = time.perf_counter()
 if _rank == 0:
     print(f"⏱ Elapsed time: {{_t1 - _t0:.6f}} s")
 """
+
+
+# --------------------------------------------------
+# %%dedalus cell magic
+# --------------------------------------------------
+@register_cell_magic
+def dedalus(line, cell):
+    args = shlex.split(line)
+
+    # -----------------------------
+    # Options
+    # -----------------------------
+    np = 1
+    info_mode = time_mode = session_mode = False
+
+    it = iter(args)
+    for arg in it:
+        if arg == "--info":
+            info_mode = True
+        elif arg == "--time":
+            time_mode = True
+        elif arg == "--session":
+            session_mode = True
+        elif arg == "--refresh-mpi":
+            _MPI_CACHE.clear()
+        elif arg == "-np":
+            try:
+                np = int(next(it))
+            except (StopIteration, ValueError):
+                print("❌ -np needs an integer, e.g. -np 4")
+                return
+
+    # -----------------------------
+    # Environment
+    # -----------------------------
+    env = _cell_env()
+
+    # -----------------------------
+    # Command builder
+    # -----------------------------
+    def build_cmd(script, *script_args):
+        if np == 1:
+            cmd = [PYTHON, script, *script_args]
+        else:
+            # Only a multi-rank run needs to know which launcher to use
+            mpi_impl, _ = detect_mpi(env)
+            launcher = MPIRUN if mpi_impl == "openmpi" else MPIEXEC
+            cmd = [launcher, "-n", str(np), PYTHON, script, *script_args]
+
+        if ENV_PREFIX:
+            return cmd
+        return [MICROMAMBA, "run", "-n", ENV_NAME, *cmd]
+
+    # -----------------------------
+    # --info mode
+    # -----------------------------
+    if info_mode:
+        # Fall back to a throwaway copy if ~/.cache wasn't writable
+        if _INFO_SCRIPT is None:
+            info_script = _script_file(_INFO_CODE)
+        else:
+            info_script = nullcontext(str(_INFO_SCRIPT))
+
+        with info_script as script:
+            # The local summary doesn't depend on the subprocess,
+            # so print it while the env's python starts up
+            process, master_fd = _spawn(build_cmd(script), env)
+            try:
+                mpi_impl, mpi_ver = detect_mpi(env)
+
+                print("🔎 dedalus runtime info")
+                print("-----------------------")
+                print(f"Environment        : {ENV_NAME}")
+                print(f"micromamba         : {MICROMAMBA}")
+                print(f"MPI implementation : {mpi_impl.upper()}")
+                print(f"MPI version        : {mpi_ver}")
+                print(f"MPI ranks (-np)    : {np}")
+            except BaseException:
+                # _stream hasn't taken over the child and its pty yet
+                _interrupt(process)
+                os.close(master_fd)
+                raise
+
+            _stream(process, master_fd)
+        return
+
+    # -----------------------------
+    # Normal execution (with optional timing)
+    # -----------------------------
+    # Cells are usually written at column 0; only dedent when some line
+    # could actually share a leading-whitespace prefix
+    if cell.startswith((" ", "\t")) or "\n " in cell or "\n\t" in cell:
+        user_code = textwrap.dedent(cell)
+    else:
+        user_code = cell
+
+    if time_mode:
+        wrapped = _TIME_WRAPPER.format(user_code=user_code)
     else:
         wrapped = user_code
 
-    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
-        f.write(wrapped)
-        script = f.name
+    if session_mode:
+        # the launcher keeps the env it started with, so a changed env
+        # (e.g. OMP_NUM_THREADS set in the notebook) needs a new session
+        key = (np, tuple(sorted(env.items())))
+        session = _get_session(key, np, build_cmd, env)
+        with _script_file(wrapped) as script:
+            done = False
+            try:
+                done = session.run(script)
+            except KeyboardInterrupt:
+                _interrupt(session.process)
+                raise
+            finally:
+                if not done:
+                    _SESSIONS.pop(key).close()
+        return
 
-    try:
-        res = subprocess.run(
-            build_cmd(script),
-            env=env, capture_output=True, text=True
-        )
-        print(res.stdout, end="")
-        print(res.stderr, end="")
-    finally:
-        os.remove(script)
\ No newline at end of file
+    with _script_file(wrapped) as script:
+        _run_streamed(build_cmd(script), env)
\ No newline at end of file
@@ -12,20 +12,6 @@ MAGIC_FILE     = REPO_DIR / "magic" / "dedalus_magic.py"
 
 MICROMAMBA = "/content/micromamba/bin/micromamba"
 
-# ==================================================
-# Helpers
-# ==================================================
-def run(cmd, cwd=None):
-    #print("   $", " ".join(map(str, cmd)))
-    result = subprocess.run(
-        cmd, 
-        cwd=cwd, 
-        check=True,
-        capture_output=True,
-        text=True
-    )
-    return result
-
 # ==================================================
 # Sanity checks
 # ==================================================
@@ -53,14 +39,29 @@ else:
 # ==================================================
 opts = sys.argv[1:]   # e.g. --clean / --force
 print("🔧 Installing dedalus environment...")
-run(["bash", str(INSTALL_SCRIPT), *opts], cwd=REPO_DIR)
+install_cmd = ["bash", str(INSTALL_SCRIPT), *opts]
+install = subprocess.Popen(
+    install_cmd,
+    cwd=REPO_DIR,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    text=True
+)
+
+# Read and compile the magic while micromamba solves / links
+compiled = compile(MAGIC_FILE.read_text(), str(MAGIC_FILE), "exec")
+
+out, err = install.communicate()
+if install.returncode != 0:
+    raise subprocess.CalledProcessError(
+        install.returncode, install_cmd, output=out, stderr=err
+    )
 
 # ==================================================
 # 2. Load %%dedalus magic
 # ==================================================
 print("✨ Loading dedalus Jupyter magic...", end=" ")
-code = MAGIC_FILE.read_text()
-exec(compile(code, str(MAGIC_FILE), "exec"), globals())
+exec(compiled, globals())
 print("%%dedalus registered")
 
 # # ==================================================
@@ -68,11 +69,11 @@ print("%%dedalus registered")
 # # ==================================================
 # if TEST_FILE.exists():
 #     print("\n🧪 Running dedalus self-test...")
-#     run([
+#     subprocess.run([
 #         MICROMAMBA, "run", "-n", "dedalus",
 #         "mpiexec", "-n", "4",
 #         "python", str(TEST_FILE)
-#     ])
+#     ], check=True)
 #     print("🧪 dedalus self-test passed ✅")
 # else:
 #     print("⚠️ No self-test found — skipping")
\ No newline at end of file